@@ -1,16 +1,19 @@
-import inspect
 import logging
 import os
 import socket
 import sys
-from datetime import datetime
-from typing import Tuple, Optional, Callable, Union, NewType, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from io import BytesIO
+from typing import Tuple, Optional, List, Union, Dict
 
-import pytz
+import orjson
 import requests
 import urllib3
-from bs4 import BeautifulSoup, Tag
-from telegram import Bot
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 WOOG_TEMPERATURE_URL = os.getenv("WOOG_TEMPERATURE_URL") or "https://woog.iot.service.itrm.de/?accesstoken=LQ8MXn"
 # noinspection HttpUrlsUsage
@@ -19,13 +22,28 @@ BACKEND_URL = os.getenv("BACKEND_URL") or "https://api.woog.life"
 BACKEND_PATH = os.getenv("BACKEND_PATH") or "lake/{}/temperature"
 WOOG_UUID = os.getenv("LARGE_WOOG_UUID")
 API_KEY = os.getenv("API_KEY")
+BACKEND_FULL_URL = f"{BACKEND_URL.rstrip('/')}/{BACKEND_PATH.format(WOOG_UUID)}"
+BACKEND_HEADERS = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+# (connect, read) in seconds
+REQUEST_TIMEOUT = (2, 5)
+# raise_on_status=False hands back the last 5xx response instead of raising, so its status and body get reported
+REQUEST_RETRY = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["GET", "PUT"],
+                      raise_on_status=False)
 
-WATER_INFORMATION = NewType("WaterInformation", Tuple[str, float])
-AIR_INFORMATION = NewType("AirInformation", Tuple[str, float])
+# one session for the website and the backend so connections are kept alive and reused
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=REQUEST_RETRY))
+SESSION.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=REQUEST_RETRY))
+
+MEASUREMENT_TAGS = ("Water_Temperature", "Air_Temperature")
+TELEGRAM_MAX_WORKERS = 8
 
 
 def create_logger(name: str, level: int = logging.DEBUG) -> logging.Logger:
-    logger = logging.Logger(name)
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+
     ch = logging.StreamHandler(sys.stdout)
 
     formatting = "[{}] %(asctime)s\t%(levelname)s\t%(module)s.%(funcName)s#%(lineno)d | %(message)s".format(name)
@@ -34,133 +52,134 @@ def create_logger(name: str, level: int = logging.DEBUG) -> logging.Logger:
 
     logger.addHandler(ch)
     logger.setLevel(level)
+    logger.propagate = False
 
     return logger
 
 
+logger = create_logger("scraper")
+
+
 def send_telegram_alert(message: str, token: str, chatlist: List[str]):
-    logger = create_logger(inspect.currentframe().f_code.co_name)
     if not token:
         logger.error("TOKEN not defined in environment, skip sending telegram message")
         return
 
+    # an unset TELEGRAM_CHATLIST arrives as [""]
+    chatlist = [chat for chat in chatlist if chat]
     if not chatlist:
         logger.error("chatlist is empty (env var: TELEGRAM_CHATLIST)")
+        return
 
-    for user in chatlist:
-        Bot(token=token).send_message(chat_id=user, text=f"(scraper) Error while executing: {message}")
+    # only needed on failure, keep the telegram import chain out of regular runs
+    from telegram import Bot
+    from telegram.utils.request import Request
 
+    # send to the chats concurrently, the connection pool has to be large enough for every worker
+    workers = min(len(chatlist), TELEGRAM_MAX_WORKERS)
+    bot = Bot(token=token, request=Request(con_pool_size=workers))
+    send = bot.send_message
+    text = f"(scraper) Error while executing: {message}"
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # consume the results so a failed send is raised here instead of being swallowed
+        list(executor.map(lambda user: send(chat_id=user, text=text), chatlist))
 
-def get_website() -> Tuple[str, bool]:
-    logger = create_logger(inspect.currentframe().f_code.co_name)
+
+def get_website() -> Tuple[Union[bytes, str], bool]:
     url = WOOG_TEMPERATURE_URL
 
-    logger.debug(f"Requesting {url}")
-    response = requests.get(url)
+    logger.debug("Requesting %s", url)
+    try:
+        response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logger.exception(f"Error while requesting website ({url})", exc_info=True)
+        return str(e), False
 
-    content = response.content.decode("utf-8")
-    logger.debug(content)
+    content = response.content
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("website content: %s", content.decode("utf-8", "replace"))
 
     return content, True
 
 
-def parse_website_xml(xml: str) -> BeautifulSoup:
-    return BeautifulSoup(xml, "xml")
-
-
-def get_tag_text_from_xml(xml: Union[BeautifulSoup, Tag], name: str, conversion: Callable) -> Optional:
-    tag = xml.find(name)
-
-    if not tag:
-        return None
+@lru_cache(maxsize=64)
+def timestamp_to_iso(timestamp_ms: int) -> str:
+    # the website reports epoch milliseconds, the backend expects an utc iso timestamp
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).isoformat()
 
-    return conversion(tag.text)
 
+def parse_website_xml(xml: bytes) -> Dict[str, Dict[str, str]]:
+    # single pass over the document, only the value/ts texts below the measurement tags are kept.
+    # tags are matched by their local name so a namespaced feed still works
+    measurements = {}
+    for _, element in etree.iterparse(BytesIO(xml), events=("end",)):
+        parent = element.getparent()
+        name = etree.QName(element).localname
+        if name in ("value", "ts") and parent is not None:
+            parent_name = etree.QName(parent).localname
+            if parent_name in MEASUREMENT_TAGS:
+                measurements.setdefault(parent_name, {}).setdefault(name, element.text)
 
-def get_air_information(soup: BeautifulSoup) -> Optional[AIR_INFORMATION]:
-    logger = create_logger(inspect.currentframe().f_code.co_name)
+        # drop everything that has been processed so the tree doesn't grow with the document
+        element.clear()
+        while parent is not None and element.getprevious() is not None:
+            del parent[0]
 
-    air_temperature_tag = soup.find("Air_Temperature")
-    logger.debug(f"air_temperature_tag: {air_temperature_tag}")
-    if not air_temperature_tag:
-        logger.error(f"air_Temperature not present in {soup}")
-        return
+    return measurements
 
-    try:
-        temperature = get_tag_text_from_xml(air_temperature_tag, "value", float)
-    except ValueError:
-        logger.error("value_tag was not of type float")
-        return
 
-    if temperature is None:
-        logger.error(f"temperature was None in air_temperature value tag ({air_temperature_tag})")
-        return
+def read_measurement(measurements: Dict[str, Dict[str, str]], tag: str) -> Tuple[Optional[Tuple[str, float]], str]:
+    measurement = measurements.get(tag, {})
+    logger.debug("%s: %s", tag, measurement)
+    value = measurement.get("value")
+    if value is None:
+        message = f"{tag}/value not present ({measurement})"
+        logger.error(message)
+        return None, message
 
     try:
-        iso_time: int = get_tag_text_from_xml(air_temperature_tag, "ts",
-                                              lambda x: datetime.fromtimestamp(int(x) / 1000).isoformat())
+        temperature = float(value)
     except ValueError:
-        logger.exception("ts_tag is not valid", exc_info=True)
-        return
-
-    # noinspection PyTypeChecker
-    # at this point pycharm doesn't think that the return type can be optional despite the many empty returns beforehand
-    return iso_time, temperature
-
-
-def get_water_information(soup: BeautifulSoup) -> Optional[WATER_INFORMATION]:
-    logger = create_logger(inspect.currentframe().f_code.co_name)
-
-    water_temperature_tag = soup.find("Water_Temperature")
-    logger.debug(f"water_temperature_tag: {water_temperature_tag}")
-    if not water_temperature_tag:
-        logger.error(f"Water_Temperature not present in {soup}")
-        return
+        message = f"{tag}/value was not of type float ({measurement})"
+        logger.error(message)
+        return None, message
 
-    try:
-        temperature = get_tag_text_from_xml(water_temperature_tag, "value", float)
-    except ValueError:
-        logger.error("value_tag was not of type float")
-        return
+    if tag == "Water_Temperature" and temperature <= 0:
+        message = f"water_temperature is <= 0 ({temperature}), please approve this manually."
+        logger.error(message)
+        return None, message
 
-    if temperature is None:
-        logger.error(f"temperature was None in water_temperature value tag ({water_temperature_tag})")
-        return
+    timestamp = measurement.get("ts")
+    if timestamp is None:
+        message = f"{tag}/ts not present ({measurement})"
+        logger.error(message)
+        return None, message
 
     try:
-        time: datetime = get_tag_text_from_xml(water_temperature_tag, "ts",
-                                               lambda x: datetime.fromtimestamp(int(x) / 1000))
-        local = pytz.timezone("Europe/Berlin")
-        time = local.localize(time)
-        iso_time = time.astimezone(pytz.utc).isoformat()
-    except ValueError:
-        logger.exception("ts_tag is not valid", exc_info=True)
-        return
+        iso_time = timestamp_to_iso(int(timestamp))
+    except (ValueError, OverflowError, OSError):
+        message = f"{tag}/ts is not valid ({measurement})"
+        logger.exception(message, exc_info=True)
+        return None, message
 
-    # noinspection PyTypeChecker
-    # at this point pycharm doesn't think that the return type can be optional despite the many empty returns beforehand
-    return iso_time, temperature
+    return (iso_time, temperature), ""
 
 
-def send_data_to_backend(water_information: WATER_INFORMATION, air_information: AIR_INFORMATION) -> Tuple[
+def send_data_to_backend(water_information: Tuple[str, float], air_information: Tuple[str, float]) -> Tuple[
     Optional[requests.Response], str]:
-    logger = create_logger(inspect.currentframe().f_code.co_name)
-    path = BACKEND_PATH.format(WOOG_UUID)
-    url = "/".join([BACKEND_URL, path])
+    url = BACKEND_FULL_URL
 
     water_timestamp, water_temperature = water_information
     air_timestamp, air_temperature = air_information
-    if water_temperature <= 0:
-        return None, "water_temperature is <= 0, please approve this manually."
 
-    headers = {"Authorization": f"Bearer {API_KEY}"}
     data = {"temperature": water_temperature, "time": water_timestamp}
-    logger.debug(f"Send {data} to {url}")
+    logger.debug("Send %s to %s", data, url)
 
     try:
-        response = requests.put(url, json=data, headers=headers)
-        logger.debug(f"success: {response.ok} | content: {response.content}")
-    except (requests.exceptions.ConnectionError, socket.gaierror, urllib3.exceptions.MaxRetryError):
+        response = SESSION.put(url, data=orjson.dumps(data), headers=BACKEND_HEADERS, timeout=REQUEST_TIMEOUT)
+        logger.debug("success: %s | content: %s", response.ok, response.content)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, socket.gaierror,
+            urllib3.exceptions.MaxRetryError):
         logger.exception(f"Error while connecting to backend ({url})", exc_info=True)
         return None, url
 
@@ -168,49 +187,51 @@ def send_data_to_backend(water_information: WATER_INFORMATION, air_information:
 
 
 def main() -> Tuple[bool, str]:
-    logger = create_logger(inspect.currentframe().f_code.co_name)
     content, success = get_website()
     if not success:
         message = f"Couldn't retrieve website: {content}"
         logger.error(message)
         return False, message
 
-    soup = parse_website_xml(content)
+    try:
+        measurements = parse_website_xml(content)
+    except etree.XMLSyntaxError as e:
+        message = f"Couldn't parse website xml: {e}"
+        logger.error(message)
+        return False, message
 
-    water_information = get_water_information(soup)
-    air_information = get_air_information(soup)
+    water_information, water_error = read_measurement(measurements, "Water_Temperature")
+    air_information, air_error = read_measurement(measurements, "Air_Temperature")
 
     if not water_information:
-        message = f"Couldn't retrieve water information from {soup}"
-        logger.error(message)
-        return False, message
+        return False, water_error
 
     if not air_information:
-        message = f"Couldn't retrieve air information from {soup}"
-        logger.error(message)
-        return False, message
+        return False, air_error
 
     response, generated_backend_url = send_data_to_backend(water_information, air_information)
 
     if not response or not response.ok:
-        message = f"Failed to put data ({water_information}) to backend: {generated_backend_url}\n{response.content}"
+        content = response.content if response is not None else "no response"
+        message = f"Failed to put data ({water_information}) to backend: {generated_backend_url}\n{content}"
         logger.error(message)
         return False, message
 
     return True, ""
 
 
-root_logger = create_logger("__main__")
-
-if not WOOG_UUID:
-    root_logger.error("LARGE_WOOG_UUID not defined in environment")
-elif not API_KEY:
-    root_logger.error("API_KEY not defined in environment")
-else:
-    success, message = main()
-    if not success:
-        root_logger.error(f"Something went wrong ({message})")
-        token = os.getenv("TOKEN")
-        chatlist = os.getenv("TELEGRAM_CHATLIST") or ""
-        send_telegram_alert(message, token=token, chatlist=chatlist.split(","))
-        sys.exit(1)
+if __name__ == "__main__":
+    root_logger = create_logger("__main__")
+
+    if not WOOG_UUID:
+        root_logger.error("LARGE_WOOG_UUID not defined in environment")
+    elif not API_KEY:
+        root_logger.error("API_KEY not defined in environment")
+    else:
+        success, message = main()
+        if not success:
+            root_logger.error(f"Something went wrong ({message})")
+            token = os.getenv("TOKEN")
+            chatlist = os.getenv("TELEGRAM_CHATLIST") or ""
+            send_telegram_alert(message, token=token, chatlist=chatlist.split(","))
+            sys.exit(1)